@@ -1,7 +1,9 @@
 from __future__ import print_function
 
+import functools
+import re
 import sys
-from typing import List
+from typing import Dict, List
 
 import web
 import os
@@ -10,27 +12,93 @@ import shutil
 import babel
 from babel._compat import BytesIO
 from babel.support import Translations
-from babel.messages import Catalog
-from babel.messages.pofile import read_po, write_po
-from babel.messages.mofile import write_mo
-from babel.messages.extract import extract_from_file, extract_from_dir, extract_python
+from babel.util import pathmatch
+
+# babel.messages, and the process pool, hashing and temp file modules, are only
+# needed by the extract/compile/update commands, not for serving pages, so
+# they're imported where they're used.
 
 root = os.path.dirname(__file__)
 
-def _compile_translation(po, mo):
+METHODS = [
+    ("**.py", "python"),
+    ("**.html", "openlibrary.i18n:extract_templetor")
+]
+COMMENT_TAGS = ["NOTE:"]
+# Never hold message sources but can be huge (installed JS packages, build
+# output, vendored code), so the extraction walk doesn't descend into them.
+# Directories starting with '.' or '_' (.git, __pycache__) are skipped too.
+EXTRACT_IGNORED_DIRS = {'node_modules', 'build', 'dist', 'vendor'}
+
+# Code generated from templates by extract_templetor is cached here, keyed on
+# the template's path, mtime and size. Bump _TEMPLATE_CACHE_VERSION whenever
+# extract_templetor changes the code it generates. Entries are never pruned, so
+# every template edit leaves a stale file behind; the directory can safely be
+# deleted at any time.
+TEMPLATE_CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+    'openlibrary-i18n', 'tmpl'
+)
+_TEMPLATE_CACHE_VERSION = 1
+
+
+@functools.lru_cache(maxsize=None)
+def _i18n_call_re():
+    """Returns a regex matching a call to any of the functions babel extracts
+    messages from. It also matches templetor's `$_(` and `$:_(`, as `$` and `:`
+    are word boundaries.
+    """
+    from babel.messages.extract import DEFAULT_KEYWORDS
+    keywords = b'|'.join(re.escape(k).encode() for k in DEFAULT_KEYWORDS)
+    return re.compile(rb'\b(?:%s)\s*\(' % keywords)
+
+
+def _open_po(path, mode='rb'):
+    """Opens a po/pot/mo file with a large buffer, so babel's line-by-line reads
+    and small writes don't each turn into a syscall.
+    """
+    return open(path, mode, buffering=1 << 20)
+
+
+def _write_mo(catalog, mo):
+    from babel.messages.mofile import write_mo
+
+    # write_mo makes a small write per message; assemble the file in memory
+    # and write it out in one go instead
+    buf = BytesIO()
+    write_mo(buf, catalog)
+    with open(mo, 'wb') as f:
+        f.write(buf.getvalue())
+
+
+def _compile_catalog(catalog, po, mo):
+    """Compiles the already parsed catalog of the po file to mo."""
     try:
-        catalog = read_po(open(po, 'rb'))
-
-        f = open(mo, 'wb')
-        write_mo(f, catalog)
-        f.close()
+        _write_mo(catalog, mo)
         print('compiled', po, file=web.debug)
-    except Exception as e:
+    except Exception:
+        print('failed to compile', po, file=web.debug)
+        raise
+
+
+def _compile_translation(po, mo):
+    from babel.messages.pofile import read_po
+
+    try:
+        with _open_po(po) as f:
+            catalog = read_po(f)
+    except Exception:
         print('failed to compile', po, file=web.debug)
-        raise e
+        raise
+    _compile_catalog(catalog, po, mo)
 
 
 def _validate_catalog(catalog, locale):
+    # Most catalogs have nothing fuzzy in them, so check for that cheaply before
+    # building any error messages
+    if not any(message.fuzzy for message in catalog):
+        return True
+
     validation_errors = []
     for message in catalog:
         if message.fuzzy:
@@ -55,12 +123,15 @@ def _validate_catalog(catalog, locale):
 
 
 def validate_translations(args):
+    from babel.messages.pofile import read_po
+
     if args:
         locale = args[0]
         po_path = os.path.join(root, locale, 'messages.po')
 
         if os.path.exists(po_path):
-            catalog = read_po(open(po_path, 'rb'))
+            with _open_po(po_path) as f:
+                catalog = read_po(f)
             is_valid = _validate_catalog(catalog, locale)
 
             if is_valid:
@@ -75,94 +146,236 @@ def validate_translations(args):
 
 
 def get_locales():
-    return [
-        d
-        for d in os.listdir(root)
-        if (os.path.isdir(os.path.join(root, d)) and
-            os.path.exists(os.path.join(root, d, 'messages.po')))
-    ]
+    with os.scandir(root) as entries:
+        return [
+            entry.name
+            for entry in entries
+            if (entry.is_dir() and
+                os.path.exists(os.path.join(entry.path, 'messages.po')))
+        ]
+
+
+def _templetor_cache_path(fileobj):
+    """Returns the path generated code for this template is cached at, or None
+    if fileobj isn't backed by a file on disk.
+    """
+    import hashlib
+
+    try:
+        st = os.fstat(fileobj.fileno())
+    except (AttributeError, OSError):
+        return None
+    key = (
+        f'{_TEMPLATE_CACHE_VERSION}:{web.__version__}:'
+        f'{os.path.abspath(fileobj.name)}:{st.st_mtime_ns}:{st.st_size}'
+    )
+    filename = hashlib.blake2b(key.encode('utf-8')).hexdigest() + '.py'
+    return os.path.join(TEMPLATE_CACHE_DIR, filename)
+
+
+def _read_templetor_cache(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def _write_templetor_cache(path, code):
+    # The cache is only an optimisation, so failing to write it isn't fatal.
+    # Writes go through a temp file so that a concurrent reader never sees a
+    # partially written entry.
+    import tempfile
+
+    try:
+        os.makedirs(TEMPLATE_CACHE_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=TEMPLATE_CACHE_DIR)
+    except OSError as e:
+        print('Failed to cache ' + path + ':', repr(e), file=web.debug)
+        return
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(code)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        os.unlink(tmp_path)
+        print('Failed to cache ' + path + ':', repr(e), file=web.debug)
+
 
 def extract_templetor(fileobj, keywords, comment_tags, options):
     """Extract i18n messages from web.py templates."""
-    try:
-        instring = fileobj.read().decode('utf-8')
-        # Replace/remove inline js '\$' which interferes with the Babel python parser:
-        cleaned_string = instring.replace('\$', '')
-        code = web.template.Template.generate_code(cleaned_string, fileobj.name)
-        f = BytesIO(code.encode('utf-8')) # Babel wants bytes, not strings
-    except Exception as e:
-        print('Failed to extract ' + fileobj.name + ':', repr(e), file=web.debug)
-        return []
-    return extract_python(f, keywords, comment_tags, options)
+    from babel.messages.extract import extract_python
+
+    cache_path = _templetor_cache_path(fileobj)
+    code = _read_templetor_cache(cache_path) if cache_path else None
+    if code is None:
+        try:
+            instring = fileobj.read().decode('utf-8')
+            # Replace/remove inline js '\$' which interferes with the Babel
+            # python parser:
+            cleaned_string = instring.replace('\\$', '')
+            code = web.template.Template.generate_code(cleaned_string, fileobj.name)
+            code = code.encode('utf-8')  # Babel wants bytes, not strings
+        except Exception as e:
+            print('Failed to extract ' + fileobj.name + ':', repr(e), file=web.debug)
+            return []
+        if cache_path:
+            _write_templetor_cache(cache_path, code)
+    return extract_python(BytesIO(code), keywords, comment_tags, options)
+
+
+def _file_has_i18n(path):
+    """Cheaply checks whether the file calls a gettext function at all, without
+    decoding or parsing it.
+    """
+    import mmap
+
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return False
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return _i18n_call_re().search(mm) is not None
+
+
+def _walk_extraction_tasks(dirname):
+    """Yields (filepath, filename, method) for every file under dirname that
+    matches METHODS, walking the tree the same way babel's extract_from_dir does
+    but without descending into EXTRACT_IGNORED_DIRS. Files without any gettext
+    calls are skipped, as they have nothing to extract.
+    """
+    absname = os.path.abspath(dirname)
+    for dirpath, dirnames, filenames in os.walk(absname):
+        dirnames[:] = sorted(
+            subdir for subdir in dirnames
+            if not (subdir.startswith('.') or subdir.startswith('_') or
+                    subdir in EXTRACT_IGNORED_DIRS)
+        )
+        for filename in sorted(filenames):
+            filepath = os.path.join(dirpath, filename).replace(os.sep, '/')
+            relname = os.path.relpath(filepath, absname)
+            for pattern, method in METHODS:
+                if pathmatch(pattern, relname):
+                    if _file_has_i18n(filepath):
+                        yield filepath, relname, method
+                    break
+
+
+def _extract_one(task):
+    """Extracts the messages of a single file; runs in a worker process."""
+    from babel.messages.extract import extract_from_file
+
+    filepath, filename, method = task
+    messages = extract_from_file(method, filepath, comment_tags=COMMENT_TAGS,
+                                 strip_comment_tags=True)
+    return filename, messages
 
 
 def extract_messages(dirs: List[str]):
+    import tempfile
+    from concurrent.futures import ProcessPoolExecutor
+
+    from babel.messages import Catalog
+    from babel.messages.pofile import write_po
+
     catalog = Catalog(
         project='Open Library',
         copyright_holder='Internet Archive'
     )
-    METHODS = [
-        ("**.py", "python"),
-        ("**.html", "openlibrary.i18n:extract_templetor")
-    ]
-    COMMENT_TAGS = ["NOTE:"]
 
-    for d in dirs:
-        extracted = extract_from_dir(d, METHODS, comment_tags=COMMENT_TAGS,
-                                     strip_comment_tags=True)
+    # Locations and comments are gathered per message first, so each message
+    # is added to the catalog once rather than once per occurrence.
+    messages = {}
+    setdefault = messages.setdefault
+
+    # Parsing is CPU-bound, so files are fanned out across processes. The
+    # results come back in walk order so that messages.pot stays stable.
+    with ProcessPoolExecutor() as executor:
+        for d in dirs:
+            tasks = list(_walk_extraction_tasks(d))
+
+            counts = {}
+            for filename, extracted in executor.map(_extract_one, tasks,
+                                                    chunksize=32):
+                for lineno, message, comments, context in extracted:
+                    counts[filename] = counts.get(filename, 0) + 1
+                    locations, auto_comments = setdefault(message, ([], []))
+                    locations.append((filename, lineno))
+                    auto_comments.extend(comments)
+
+            for filename, count in counts.items():
+                path = filename if d == filename else os.path.join(d, filename)
+                print(f"{count}\t{path}", file=sys.stderr)
+
+    for message, (locations, auto_comments) in messages.items():
+        catalog.add(message, None, locations, auto_comments=auto_comments)
+
+    # Write the template out in one go, via a temp file so that an interrupted
+    # run never leaves a truncated messages.pot behind
+    buf = BytesIO()
+    write_po(buf, catalog)
+    path = os.path.join(root, 'messages.pot')
+    fd, tmp_path = tempfile.mkstemp(dir=root, prefix='messages.pot.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(buf.getvalue())
+        # mkstemp creates the file readable by its owner only
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
 
-        counts = {}
-        for filename, lineno, message, comments, context in extracted:
-            counts[filename] = counts.get(filename, 0) + 1
-            catalog.add(message, None, [(filename, lineno)], auto_comments=comments)
+    print('wrote template to', path)
 
-        for filename, count in counts.items():
-            path = filename if d == filename else os.path.join(d, filename)
-            print(f"{count}\t{path}", file=sys.stderr)
 
-    path = os.path.join(root, 'messages.pot')
-    f = open(path, 'wb')
-    write_po(f, catalog)
-    f.close()
+def _compile_locale(locale):
+    po_path = os.path.join(root, locale, 'messages.po')
+    mo_path = os.path.join(root, locale, 'messages.mo')
 
-    print('wrote template to', path)
+    if os.path.exists(po_path):
+        _compile_translation(po_path, mo_path)
 
 
 def compile_translations(locales: List[str]):
+    from concurrent.futures import ProcessPoolExecutor
+
     locales_to_update = locales or get_locales()
 
-    for locale in locales_to_update:
-        po_path = os.path.join(root, locale, 'messages.po')
-        mo_path = os.path.join(root, locale, 'messages.mo')
-
-        if os.path.exists(po_path):
-            _compile_translation(po_path, mo_path)
+    # Locales are independent of each other, so compile them in parallel.
+    # Consuming the results re-raises any failure here.
+    with ProcessPoolExecutor() as executor:
+        list(executor.map(_compile_locale, locales_to_update, chunksize=4))
 
 
 def update_translations(locales: List[str]):
+    from babel.messages.pofile import read_po, write_po
+
     locales_to_update = locales or get_locales()
     print(f"Updating {locales_to_update}")
 
     pot_path = os.path.join(root, 'messages.pot')
-    template = read_po(open(pot_path, 'rb'))
+    with _open_po(pot_path) as f:
+        template = read_po(f)
 
     for locale in locales_to_update:
         po_path = os.path.join(root, locale, 'messages.po')
         mo_path = os.path.join(root, locale, 'messages.mo')
 
         if os.path.exists(po_path):
-            catalog = read_po(open(po_path, 'rb'))
+            with _open_po(po_path) as f:
+                catalog = read_po(f)
             catalog.update(template)
 
-            f = open(po_path, 'wb')
-            write_po(f, catalog)
-            f.close()
+            with _open_po(po_path, 'wb') as f:
+                write_po(f, catalog)
             print('updated', po_path)
+
+            # Compile from the catalog already in memory rather than parsing
+            # the po file we just wrote all over again
+            _compile_catalog(catalog, po_path, mo_path)
         else:
             print(f"ERROR: {po_path} does not exist...")
 
-    compile_translations(locales_to_update)
-
 
 def generate_po(args):
     if args:
@@ -170,48 +383,98 @@ def generate_po(args):
         pot_src = os.path.join(root, 'messages.pot')
         po_dest = os.path.join(po_dir, 'messages.po')
 
-        if os.path.exists(po_dir):
-            if os.path.exists(po_dest):
-                print(f"Portable object file already exists at {po_dest}")
-            else:
-                shutil.copy(pot_src, po_dest)
-                os.chmod(po_dest, 0o666)
-                print(f"File created at {po_dest}")
-        else:
+        try:
             os.mkdir(po_dir)
+            # mkdir's mode argument is masked by the umask, so chmod explicitly
             os.chmod(po_dir, 0o777)
-            shutil.copy(pot_src, po_dest)
+        except FileExistsError:
+            pass
+
+        if os.path.exists(po_dest):
+            print(f"Portable object file already exists at {po_dest}")
+        else:
+            # copyfile uses os.sendfile where available, so the copy stays in
+            # the kernel. Don't be tempted to hard link instead: the po file is
+            # later rewritten in place by update_translations (and by editors),
+            # which would clobber messages.pot through the shared inode.
+            shutil.copyfile(pot_src, po_dest)
             os.chmod(po_dest, 0o666)
             print(f"File created at {po_dest}")
     else:
         print("Add failed. Missing required locale code.")
 
 
-@web.memoize
+@functools.lru_cache(maxsize=None)
 def load_translations(lang):
     po = os.path.join(root, lang, 'messages.po')
     mo_path = os.path.join(root, lang, 'messages.mo')
 
     if os.path.exists(mo_path):
-        return Translations(open(mo_path, 'rb'))
+        # mo files are small; read them whole so the file is closed right away
+        # instead of whenever the unreferenced file object gets collected
+        with open(mo_path, 'rb') as f:
+            return Translations(BytesIO(f.read()))
+
 
-@web.memoize
+@functools.lru_cache(maxsize=None)
 def load_locale(lang):
     try:
         return babel.Locale(lang)
     except babel.UnknownLocaleError:
         pass
 
+
+# GetText runs for every translated string that is rendered, so it looks
+# messages up in a plain dict per language, flattened from the Translations
+# catalog, rather than calling through load_translations and ugettext.
+_MESSAGES_BY_LANG: Dict[str, Dict[str, str]] = {}
+
+
+# Messages are written in English, so there's never anything to look up for
+# these; most requests are served in English.
+_SOURCE_LANGS = frozenset(['en', None])
+
+
+def _load_messages(lang):
+    translations = load_translations(lang)
+    catalog = translations._catalog if translations else {}
+    # Plural forms are keyed on (msgid, index) and only used by ungettext. No
+    # message contexts are used, so every other key is a plain msgid.
+    messages = _MESSAGES_BY_LANG[lang] = {
+        msgid: msgstr
+        for msgid, msgstr in catalog.items()
+        if isinstance(msgid, str) and msgstr
+    }
+    return messages
+
+
+def clear_translations_cache():
+    """Forgets all loaded translations, e.g. so recompiled mo files are picked up.
+
+    _MESSAGES_BY_LANG is derived from load_translations, so both are cleared.
+    """
+    load_translations.cache_clear()
+    _MESSAGES_BY_LANG.clear()
+
+
 class GetText:
     def __call__(self, string, *args, **kwargs):
         """Translate a given string to the language of the current locale."""
         # Get the website locale from the global ctx.lang variable, set in i18n_loadhook
-        translations = load_translations(web.ctx.lang)
-        value = (translations and translations.ugettext(string)) or string
+        lang = web.ctx.lang
+        if lang in _SOURCE_LANGS:
+            value = string
+        else:
+            try:
+                messages = _MESSAGES_BY_LANG[lang]
+            except KeyError:
+                messages = _load_messages(lang)
+            value = messages.get(string, string)
 
         if args:
             value = value % args
-        elif kwargs:
+        elif kwargs and '%' in value:
+            # Formatting with a mapping is a no-op when there's no placeholder
             value = value % kwargs
 
         return value
@@ -224,29 +487,57 @@ class GetText:
 class LazyGetText:
     def __call__(self, string, *args, **kwargs):
         """Translate a given string lazily."""
-        return LazyObject(lambda: GetText()(string, *args, **kwargs))
+        return LazyObject(functools.partial(gettext, string, *args, **kwargs))
 
 class LazyObject:
+    __slots__ = ('_creator', '_cached')
+
     def __init__(self, creator):
         self._creator = creator
+        self._cached = None
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        # Forms holding lazy strings are deep-copied for every request. Apart
+        # from its per-language cache a LazyObject is immutable, so it can be
+        # shared; copying the creator would also try to copy the GetText it
+        # is bound to, whose __getattr__ doesn't raise AttributeError.
+        return self
+
+    def _get(self):
+        # Lazy strings usually live at module level and are rendered for
+        # requests in different languages, so the result is only reused for
+        # the language it was created in. The (lang, result) pair is swapped
+        # in as a whole to stay consistent across threads.
+        lang = web.ctx.lang
+        cached = self._cached
+        if cached is None or cached[0] != lang:
+            cached = self._cached = (lang, self._creator())
+        return cached[1]
 
     def __str__(self):
-        return web.safestr(self._creator())
+        return web.safestr(self._get())
 
     def __repr__(self):
-        return repr(self._creator())
+        return repr(self._get())
 
     def __add__(self, other):
-        return self._creator() + other
+        return self._get() + other
 
     def __radd__(self, other):
-        return other + self._creator()
+        return other + self._get()
 
 
 def ungettext(s1, s2, _n, *a, **kw):
     # Get the website locale from the global ctx.lang variable, set in i18n_loadhook
-    translations = load_translations(web.ctx.lang)
-    value = translations and translations.ungettext(s1, s2, _n)
+    lang = web.ctx.lang
+    if lang in _SOURCE_LANGS:
+        value = None
+    else:
+        translations = load_translations(lang)
+        value = translations and translations.ungettext(s1, s2, _n)
     if not value:
         # fallback when translation is not provided
         if _n == 1:
@@ -256,7 +547,7 @@ def ungettext(s1, s2, _n, *a, **kw):
 
     if a:
         return value % a
-    elif kw:
+    elif kw and '%' in value:
         return value % kw
     else:
         return value
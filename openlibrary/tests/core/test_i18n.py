@@ -1,10 +1,23 @@
+import copy
+import os
+from io import BytesIO
+
+import pytest
 import web
+from babel.messages import Catalog
+from babel.messages.extract import DEFAULT_KEYWORDS
+from babel.messages.mofile import write_mo
+from babel.support import Translations
 from openlibrary.mocks.mock_infobase import MockSite
 
 # The i18n module should be moved to core.
 from openlibrary import i18n
 
 class MockTranslations(dict):
+    @property
+    def _catalog(self):
+        return self
+
     def gettext(self, message):
         return self.get(message, message)
 
@@ -21,12 +34,24 @@ class MockLoadTranslations(dict):
     def init(self, lang, translations):
         self[lang] = MockTranslations(translations)
 
-class Test_ungettext:
+
+def make_translations(messages):
+    catalog = Catalog(locale='fr')
+    for msgid, msgstr in messages.items():
+        catalog.add(msgid, msgstr)
+    buf = BytesIO()
+    write_mo(buf, catalog)
+    buf.seek(0)
+    return Translations(buf)
+
+
+class MockI18nContext:
     def setup_monkeypatch(self, monkeypatch):
         self.d = MockLoadTranslations()
         ctx = web.storage()
 
         monkeypatch.setattr(i18n, "load_translations", self.d)
+        monkeypatch.setattr(i18n, "_MESSAGES_BY_LANG", {})
         monkeypatch.setattr(web, "ctx", ctx)
         monkeypatch.setattr(web.webapi, "ctx", web.ctx)
 
@@ -41,6 +66,8 @@ class Test_ungettext:
         }
         self.app.load(self.env)
 
+
+class Test_ungettext(MockI18nContext):
     def test_ungettext(self, monkeypatch):
         self.setup_monkeypatch(monkeypatch)
 
@@ -74,3 +101,233 @@ class Test_ungettext:
 
         i18n.ungettext("one book", "%(n)d books", 1, n=1) == "un libre"
         i18n.ungettext("one book", "%(n)d books", 2, n=2) == "2 libres"
+
+
+class Test_gettext(MockI18nContext):
+    def test_gettext(self, monkeypatch):
+        self.setup_monkeypatch(monkeypatch)
+        web.ctx.lang = 'fr'
+        self.d.init('fr', {
+            'book': 'libre',
+            'untranslated': '',
+            '%(n)d books': '%(n)d libres',
+        })
+
+        assert i18n.gettext("book") == "libre"
+        assert i18n.gettext("pen") == "pen"
+        assert i18n.gettext("untranslated") == "untranslated"
+        assert i18n.gettext("%(n)d books", n=2) == "2 libres"
+
+    def test_gettext_matches_babel(self, monkeypatch):
+        self.setup_monkeypatch(monkeypatch)
+        web.ctx.lang = 'fr'
+        translations = make_translations({'book': 'libre'})
+        self.d['fr'] = translations
+
+        # '' is the catalog's header entry
+        for string in ["book", "pen", ""]:
+            assert i18n.gettext(string) == translations.gettext(string)
+        assert i18n.gettext("").startswith("Project-Id-Version:")
+
+    def test_clear_translations_cache(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(web, "ctx", web.storage(lang='fr'))
+        monkeypatch.setattr(i18n, "root", str(tmp_path))
+        mo_path = tmp_path / "fr" / "messages.mo"
+        mo_path.parent.mkdir()
+
+        def compile_mo(msgstr):
+            catalog = Catalog(locale='fr')
+            catalog.add('book', msgstr)
+            with open(mo_path, 'wb') as f:
+                write_mo(f, catalog)
+
+        i18n.clear_translations_cache()
+        try:
+            compile_mo('libre')
+            assert i18n.gettext("book") == "libre"
+
+            compile_mo('livre')
+            assert i18n.gettext("book") == "libre"
+            i18n.clear_translations_cache()
+            assert i18n.gettext("book") == "livre"
+        finally:
+            i18n.clear_translations_cache()
+
+
+class Test_source_language(MockI18nContext):
+    """Messages are written in English, so no catalog is consulted for it."""
+
+    def setup_translations(self, monkeypatch):
+        self.setup_monkeypatch(monkeypatch)
+        # Were these catalogs looked up, the results would be wrong
+        for lang in ['en', None]:
+            self.d.init(lang, {'book': 'WRONG', 'books': 'WRONG'})
+        self.d.init('fr', {'book': 'libre', 'books': 'libres'})
+
+    @pytest.mark.parametrize("lang", ['en', None])
+    def test_source_language(self, monkeypatch, lang):
+        self.setup_translations(monkeypatch)
+        web.ctx.lang = lang
+
+        assert i18n.gettext("book") == "book"
+        assert i18n.gettext("%(n)d books", n=2) == "2 books"
+        assert i18n.ungettext("book", "books", 1) == "book"
+        assert i18n.ungettext("book", "books", 2) == "books"
+        assert i18n.ungettext("one book", "%(n)d books", 2, n=2) == "2 books"
+
+    def test_other_language(self, monkeypatch):
+        self.setup_translations(monkeypatch)
+        web.ctx.lang = 'fr'
+
+        assert i18n.gettext("book") == "libre"
+        assert i18n.ungettext("book", "books", 1) == "libre"
+        assert i18n.ungettext("book", "books", 2) == "libres"
+
+
+class Test_lgettext(MockI18nContext):
+    def test_deepcopy(self, monkeypatch):
+        # Forms are deep-copied per request, lazy descriptions and all
+        self.setup_monkeypatch(monkeypatch)
+        self.d.init('fr', {'book': 'libre'})
+        lazy = i18n.lgettext("book")
+        copied = copy.deepcopy({'description': lazy})['description']
+
+        web.ctx.lang = 'fr'
+        assert str(copied) == "libre"
+        web.ctx.lang = 'en'
+        assert str(copied) == "book"
+
+    def test_follows_language(self, monkeypatch):
+        # Lazy strings live at module level (e.g. form labels) and are
+        # rendered for requests in every language
+        self.setup_monkeypatch(monkeypatch)
+        self.d.init('fr', {'book': 'libre'})
+        lazy = i18n.lgettext("book")
+
+        for lang, expected in [('fr', 'libre'), ('en', 'book'), ('fr', 'libre')]:
+            web.ctx.lang = lang
+            assert str(lazy) == expected
+            assert lazy + "!" == expected + "!"
+            assert "<" + lazy == "<" + expected
+
+    def test_args(self, monkeypatch):
+        self.setup_monkeypatch(monkeypatch)
+        self.d.init('fr', {'%(n)d books': '%(n)d libres'})
+        lazy = i18n.lgettext("%(n)d books", n=2)
+
+        web.ctx.lang = 'fr'
+        assert str(lazy) == "2 libres"
+        web.ctx.lang = 'en'
+        assert str(lazy) == "2 books"
+
+
+class Test_walk_extraction_tasks:
+    def test_walk(self, tmp_path):
+        files = {
+            "a.py": '_("a")',
+            "b.html": '$_("b")',
+            "sub/c.py": '_("c")',
+            "sub/deeper/d.html": '$:_("d")',
+            "no_i18n.py": 'print("nothing to see here")',
+            "notes.txt": '_("not a matching extension")',
+            "node_modules/e.py": '_("e")',
+            "build/f.py": '_("f")',
+            "_private/g.py": '_("g")',
+            ".hidden/h.py": '_("h")',
+        }
+        for name, content in files.items():
+            path = tmp_path / name
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(content)
+
+        tasks = list(i18n._walk_extraction_tasks(str(tmp_path)))
+        assert [(filename, method) for _, filename, method in tasks] == [
+            ("a.py", "python"),
+            ("b.html", "openlibrary.i18n:extract_templetor"),
+            ("sub/c.py", "python"),
+            ("sub/deeper/d.html", "openlibrary.i18n:extract_templetor"),
+        ]
+        for filepath, filename, _ in tasks:
+            assert filepath == (tmp_path / filename).as_posix()
+
+    def test_extract_one(self, tmp_path):
+        path = tmp_path / "a.py"
+        path.write_text('x = 1\n_("Hello")\n')
+
+        task = (path.as_posix(), "a.py", "python")
+        assert i18n._extract_one(task) == ("a.py", [(2, "Hello", [], None)])
+
+
+class Test_file_has_i18n:
+    @pytest.mark.parametrize("content", [
+        '_("Hello")',
+        '$_("Hello")',
+        '<b>$:_("Hello <i>world</i>")</b>',
+        'ungettext ("book", "books", n)',
+        'N_("Hello")',
+        'self._("Hello")',
+        'gettext(\n    "Hello")',
+    ])
+    def test_matches(self, tmp_path, content):
+        path = tmp_path / "f.html"
+        path.write_text(content)
+        assert i18n._file_has_i18n(str(path))
+
+    @pytest.mark.parametrize("content", [
+        'print("Hello")',
+        'foo_("Hello")',
+        'my_gettext("Hello")',
+        '_ = gettext',
+    ])
+    def test_no_match(self, tmp_path, content):
+        path = tmp_path / "f.py"
+        path.write_text(content)
+        assert not i18n._file_has_i18n(str(path))
+
+    def test_empty_file(self, tmp_path):
+        # mmap can't map an empty file
+        path = tmp_path / "empty.py"
+        path.write_bytes(b"")
+        assert not i18n._file_has_i18n(str(path))
+
+
+class Test_extract_templetor:
+    def extract(self, path):
+        with open(path, "rb") as f:
+            extracted = i18n.extract_templetor(f, DEFAULT_KEYWORDS, [], {})
+            return [message for lineno, funcname, message, comments in extracted]
+
+    def test_cache(self, tmp_path, monkeypatch):
+        cache_dir = tmp_path / "cache"
+        monkeypatch.setattr(i18n, "TEMPLATE_CACHE_DIR", str(cache_dir))
+        path = tmp_path / "t.html"
+        path.write_text('<p>$_("Hello")</p>\n')
+
+        assert self.extract(path) == ["Hello"]
+        assert len(os.listdir(cache_dir)) == 1
+
+        # The second extraction is served from the cache
+        def generate_code(*args, **kwargs):
+            raise AssertionError("template was compiled again")
+
+        original_generate_code = web.template.Template.generate_code
+        monkeypatch.setattr(web.template.Template, "generate_code", generate_code)
+        assert self.extract(path) == ["Hello"]
+
+        # Editing the template misses the cache
+        monkeypatch.setattr(
+            web.template.Template, "generate_code", original_generate_code
+        )
+        path.write_text('<p>$_("Hello")</p>\n<p>$:_("Goodbye")</p>\n')
+        assert self.extract(path) == ["Hello", "Goodbye"]
+        assert len(os.listdir(cache_dir)) == 2
+
+    @pytest.mark.parametrize("cache_dir", ["not_a_dir", "not_a_dir/tmpl"])
+    def test_unusable_cache_dir(self, tmp_path, monkeypatch, cache_dir):
+        (tmp_path / "not_a_dir").write_text("")
+        monkeypatch.setattr(i18n, "TEMPLATE_CACHE_DIR", str(tmp_path / cache_dir))
+        path = tmp_path / "t.html"
+        path.write_text('<p>$_("Hello")</p>\n')
+
+        assert self.extract(path) == ["Hello"]
+        assert self.extract(path) == ["Hello"]